@@ -1,33 +1,68 @@
 #!/usr/bin/env python3
 from __future__ import annotations
 
+import functools
+import hashlib
+import json
+import os
 import re
 import sys
 import shutil
+import string
 import subprocess
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
+from itertools import chain, groupby
 from pathlib import Path
 from typing import Dict, List, Tuple, Optional
 from datetime import datetime, date
 
 import yaml
 
+try:
+    from yaml import CSafeDumper as _Dumper
+    _HAVE_LIBYAML = True
+except ImportError:
+    from yaml import SafeDumper as _Dumper
+    _HAVE_LIBYAML = False
+
 REPO_ROOT = Path(__file__).resolve().parents[1]
 STAGING_DIR = REPO_ROOT / "notes_staging"
 OUT_DIR = REPO_ROOT / "notes"  # generated .qmd files live here
 
-META_LINE_RE = re.compile(r"^\s*%\s*([A-Za-z0-9_\-]+)\s*:\s*(.*?)\s*$")
-
-@dataclass(frozen=True)
+# Convert LaTeX -> Markdown while preserving TeX math ($...$, $$...$$).
+# One pandoc process per note: batching notes into a single run would leak \newcommand
+# definitions between them and let one bad note fail the whole batch.
+PANDOC_ARGS = (
+    "--from=latex",
+    "--to=commonmark_x+tex_math_dollars",
+    "--wrap=none",
+)
+
+ASSET_DIRS = ("images", "assets")  # sibling folders copied next to the generated notes
+
+# How much of each .tex file parse_tex_metadata decodes at once; longer % blocks are
+# read on line by line
+META_HEAD_BYTES = 4096
+META_KEY_CHARS = frozenset(string.ascii_letters + string.digits + "_-")
+
+_SLUG_STRIP = re.compile(r"[^\w\s-]")
+_SLUG_SPACE = re.compile(r"[\s_]+")
+_SLUG_DASHES = re.compile(r"-{2,}")
+_SEG_STRIP = re.compile(r"[^\w\s-]")
+_SEG_SPACE = re.compile(r"\s+")
+
+@dataclass(frozen=True, slots=True)  # slots needs Python 3.10+
 class Note:
     title: str
     date: Optional[str]
-    tags: List[str]
+    tags: Tuple[str, ...]
     topic: str
     course: str
     slug: str
     src: Path
     out: Path  # .qmd path (absolute)
+    rel_href: str  # out relative to REPO_ROOT, as used in links
 
 def die(msg: str, code: int = 1) -> None:
     print(f"ERROR: {msg}", file=sys.stderr)
@@ -35,28 +70,42 @@ def die(msg: str, code: int = 1) -> None:
 
 def slugify(s: str) -> str:
     s = s.strip().lower()
-    s = re.sub(r"[^\w\s-]", "", s)
-    s = re.sub(r"[\s_]+", "-", s)
-    s = re.sub(r"-{2,}", "-", s).strip("-")
+    s = _SLUG_STRIP.sub("", s)
+    s = _SLUG_SPACE.sub("-", s)
+    s = _SLUG_DASHES.sub("-", s).strip("-")
     return s or "note"
 
+@functools.lru_cache(maxsize=256)  # topic/course names repeat across notes
 def safe_segment(s: str) -> str:
     s = s.strip()
-    s = re.sub(r"[^\w\s-]", "", s)
-    s = re.sub(r"\s+", "_", s)
+    s = _SEG_STRIP.sub("", s)
+    s = _SEG_SPACE.sub("_", s)
     return s or "unknown"
 
 def parse_tex_metadata(tex_path: Path) -> Dict[str, str]:
     meta: Dict[str, str] = {}
-    with tex_path.open("r", encoding="utf-8") as f:
-        for line in f:
-            if line.strip() == "":
-                continue
-            if not line.lstrip().startswith("%"):
-                break
-            m = META_LINE_RE.match(line)
-            if m:
-                meta[m.group(1).strip().lower()] = m.group(2).strip()
+    # Metadata only lives in the leading % comment block. Decode the first META_HEAD_BYTES
+    # (finished to a line boundary) in one go, and only keep reading line by line if the
+    # block runs past that
+    try:
+        with tex_path.open("rb") as f:
+            head = f.read(META_HEAD_BYTES)
+            if len(head) == META_HEAD_BYTES:
+                head += f.readline()
+            lines = chain(head.decode("utf-8").splitlines(), (l.decode("utf-8") for l in f))
+            for line in lines:
+                if line.strip() == "":
+                    continue
+                s = line.lstrip()
+                if not s.startswith("%"):
+                    break
+                # "% key: value" -- plain str ops, no regex needed
+                key, sep, value = s[1:].partition(":")
+                key = key.strip()
+                if sep and key and set(key) <= META_KEY_CHARS:
+                    meta[key.lower()] = value.strip()
+    except UnicodeDecodeError as e:
+        die(f"{tex_path} is not valid UTF-8: {e}")
     return meta
 
 def infer_topic_course(tex_path: Path) -> Tuple[str, str]:
@@ -66,9 +115,11 @@ def infer_topic_course(tex_path: Path) -> Tuple[str, str]:
         die(f"Expected notes_staging/<topic>/<course>/<file>.tex but got: {tex_path}")
     return parts[0], parts[1]
 
+@functools.lru_cache(maxsize=None)
 def parse_note_date(d: Optional[str]) -> date:
     """
     Parse YYYY-MM-DD into a date. If missing/invalid, return minimal date so it sorts last.
+    Cached: both the sidebar and homepage sorts call this for every note.
     """
     if not d:
         return date.min
@@ -77,32 +128,52 @@ def parse_note_date(d: Optional[str]) -> date:
     except Exception:
         return date.min
     
-def require_pandoc() -> None:
+def require_pandoc() -> str:
+    """
+    Returns pandoc's version line, which is part of every note's build stamp.
+    """
     try:
-        subprocess.run(["pandoc", "--version"], check=True, capture_output=True, text=True)
+        p = subprocess.run(["pandoc", "--version"], check=True, capture_output=True)
     except Exception:
         die("pandoc not found. Install pandoc and ensure it's on PATH.")
+    return p.stdout.decode("utf-8", errors="replace").partition("\n")[0].strip()
 
 def find_tex_files() -> List[Path]:
     if not STAGING_DIR.exists():
         die(f"Missing staging directory: {STAGING_DIR}")
-    return sorted(STAGING_DIR.rglob("*.tex"))
+    # Manual scandir walk: only matching entries become Path objects
+    out: List[Path] = []
+    stack = [str(STAGING_DIR)]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for e in it:
+                if e.is_dir(follow_symlinks=False):
+                    stack.append(e.path)
+                elif e.name.endswith(".tex") and e.is_file():
+                    out.append(Path(e.path))
+    return sorted(out)
 
 def build_notes_index(tex_files: List[Path]) -> List[Note]:
     notes: List[Note] = []
+    srcs_by_out: Dict[Path, Path] = {}
     for p in tex_files:
         meta = parse_tex_metadata(p)
         topic_raw, course_raw = infer_topic_course(p)
 
-        topic = safe_segment(topic_raw)
-        course = safe_segment(course_raw)
+        # Interned: these are compared over and over as sort/group keys
+        topic = sys.intern(safe_segment(topic_raw))
+        course = sys.intern(safe_segment(course_raw))
 
         title = meta.get("title") or p.stem.replace("_", " ").replace("-", " ").title()
         date = meta.get("date")
-        tags = [t.strip() for t in meta.get("tags", "").split(",") if t.strip()]
+        tags = tuple(t.strip() for t in meta.get("tags", "").split(",") if t.strip())
 
         slug = slugify(title)
         out = OUT_DIR / topic / course / f"{slug}.qmd"
+        # Notes are converted in parallel, so two sources must never share an output file
+        if out in srcs_by_out:
+            die(f"{srcs_by_out[out]} and {p} both generate {out}; give one of them a different title")
+        srcs_by_out[out] = p
 
         notes.append(Note(
             title=title,
@@ -113,115 +184,201 @@ def build_notes_index(tex_files: List[Path]) -> List[Note]:
             slug=slug,
             src=p,
             out=out,
+            rel_href=out.relative_to(REPO_ROOT).as_posix(),
         ))
     return notes
 
-def clean_generated_output() -> None:
-    if OUT_DIR.exists():
-        shutil.rmtree(OUT_DIR)
+def clean_generated_output(notes: List[Note]) -> None:
+    """
+    Removes generated files that no longer correspond to a note (or to a staged
+    assets folder), instead of wiping OUT_DIR, so unchanged outputs are kept.
+    """
     OUT_DIR.mkdir(parents=True, exist_ok=True)
+    keep_files = {n.out for n in notes} | {_stamp_path(n) for n in notes}
+    keep_dirs = {
+        n.out.parent / folder_name
+        for n in notes
+        for folder_name in ASSET_DIRS
+        if (n.src.parent / folder_name).is_dir()
+    }
 
-def tex_to_qmd(note: Note) -> None:
-    note.out.parent.mkdir(parents=True, exist_ok=True)
-
-    tmp_md = note.out.with_suffix(".md.tmp")
+    for root, dirs, files in os.walk(OUT_DIR, topdown=False):
+        root_path = Path(root)
+        if root_path in keep_dirs or any(d in root_path.parents for d in keep_dirs):
+            continue  # contents are mirrored by copy_note_assets
+        for name in files:
+            path = root_path / name
+            if path not in keep_files:
+                path.unlink()
+        if root_path != OUT_DIR and not any(root_path.iterdir()):
+            root_path.rmdir()
+
+def _yaml_quote(s: str) -> str:
+    """
+    Double-quoted YAML scalar. ASCII-only JSON escapes are valid YAML escapes, except
+    that YAML rejects surrogate pairs, so characters beyond the BMP use \\UXXXXXXXX.
+    """
+    if max(s, default="") < "\U00010000":
+        return json.dumps(s)
+    return '"' + "".join(
+        json.dumps(c)[1:-1] if ord(c) < 0x10000 else f"\\U{ord(c):08x}" for c in s
+    ) + '"'
 
-    # Convert LaTeX -> Markdown while preserving TeX math ($...$, $$...$$)
-    cmd = [
-        "pandoc",
-        str(note.src),
-        "--from=latex",
-        "--to=commonmark_x+tex_math_dollars",
-        "--wrap=none",
-        "-o", str(tmp_md),
+def _emit_frontmatter(title: str, date: Optional[str], tags: Tuple[str, ...]) -> str:
+    """
+    Emit the fixed-shape note front matter without going through PyYAML.
+    """
+    lines = [
+        "---",
+        f"title: {_yaml_quote(title)}",
+        f"date: {_yaml_quote(date) if date else 'null'}",
+        "tags: [" + ", ".join(_yaml_quote(t) for t in tags) + "]",
+        # Quarto front matter: KaTeX renders math during build (stable on GitHub Pages)
+        "format:",
+        "  html:",
+        "    html-math-method: katex",
+        "---",
     ]
-    p = subprocess.run(cmd, capture_output=True, text=True)
-    if p.returncode != 0:
-        die(f"Pandoc failed for {note.src}\n\nSTDERR:\n{p.stderr}")
-
-    body = tmp_md.read_text(encoding="utf-8")
-    tmp_md.unlink(missing_ok=True)
-
-    # Quarto front matter: KaTeX renders math during build (stable on GitHub Pages)
-    frontmatter = {
-        "title": note.title,
-        "date": note.date,
-        "tags": note.tags,
-        "format": {"html": {"html-math-method": "katex"}},
-    }
+    return "\n".join(lines) + "\n\n"
 
-    fm = "---\n" + yaml.safe_dump(frontmatter, sort_keys=False).strip() + "\n---\n\n"
-    note.out.write_text(fm + body, encoding="utf-8")
+def _stamp_path(note: Note) -> Path:
+    # Hidden sidecar next to the output; Quarto ignores dotfiles
+    return note.out.with_name(f".{note.out.name}.build_stamp")
 
-def generate_quarto_yml(notes: List[Note]) -> None:
-    tree: Dict[str, Dict[str, List[Note]]] = {}
-    for n in notes:
-        tree.setdefault(n.topic, {}).setdefault(n.course, []).append(n)
+def _build_stamp(note: Note, fm: str, pandoc_version: str) -> str:
+    h = hashlib.sha1(note.src.read_bytes())
+    h.update(fm.encode("utf-8"))
+    h.update("\0".join((pandoc_version, *PANDOC_ARGS)).encode("utf-8"))
+    return h.hexdigest()
+
+def _output_signature(out: Path) -> str:
+    st = out.stat()
+    return f"{st.st_size}:{st.st_mtime_ns}"
 
-    for topic in tree:
-        for course in tree[topic]:
-            tree[topic][course].sort(
-                key=lambda x: (parse_note_date(x.date), x.title.lower()),
-                reverse=False
-            )
+def tex_to_qmd(note: Note, pandoc_version: str) -> None:
+    note.out.parent.mkdir(parents=True, exist_ok=True)
+
+    # Skip pandoc when the output is newer than the source, is exactly the file this
+    # script last wrote (size + mtime in the stamp), and was built from the same
+    # source + metadata + pandoc. Only hash the source once the cheap checks pass
+    # (the hash catches metadata edits that keep the mtime order)
+    fm = _emit_frontmatter(note.title, note.date, note.tags)
+    stamp_path = _stamp_path(note)
+    stamp = None
+    if (
+        note.out.exists()
+        and note.out.stat().st_mtime >= note.src.stat().st_mtime
+        and stamp_path.exists()
+    ):
+        recorded, _, recorded_out = stamp_path.read_text(encoding="utf-8").partition(" ")
+        if recorded_out == _output_signature(note.out):
+            stamp = _build_stamp(note, fm, pandoc_version)
+            if recorded == stamp:
+                return
+    if stamp is None:
+        stamp = _build_stamp(note, fm, pandoc_version)
+
+    # Invalidate before touching the output, so an interrupted rewrite is never trusted
+    stamp_path.unlink(missing_ok=True)
+
+    cmd = ["pandoc", str(note.src), *PANDOC_ARGS]
+    # Frontmatter first, then pandoc writes its (UTF-8) output straight into the same file.
+    # Written to a temp file and renamed into place only once pandoc succeeded, so no
+    # failure or interrupt can leave a partial .qmd behind
+    tmp_out = note.out.with_name(f".{note.out.name}.tmp")
+    try:
+        with tmp_out.open("wb") as f:
+            f.write(fm.encode("utf-8"))
+            f.flush()  # must hit the file before pandoc starts writing at the shared offset
+            p = subprocess.run(cmd, stdout=f, stderr=subprocess.PIPE)
+        if p.returncode != 0:
+            # Raised rather than die()'d: this runs in a worker process, main() reports it
+            stderr = p.stderr.decode("utf-8", errors="replace")
+            raise RuntimeError(f"Pandoc failed for {note.src}\n\nSTDERR:\n{stderr}")
+        os.replace(tmp_out, note.out)
+    except BaseException:
+        tmp_out.unlink(missing_ok=True)
+        raise
+
+    stamp_path.write_text(f"{stamp} {_output_signature(note.out)}", encoding="utf-8")
+
+# Static parts of _quarto.yml; generate_quarto_yml only serializes the sidebar contents
+QUARTO_HEADER = """\
+project:
+  type: website
+website:
+  title: Personal Notes
+  sidebar:
+    style: docked
+    search: true
+    contents:
+"""
+QUARTO_FOOTER = """\
+  page-navigation: true
+format:
+  html:
+    theme: cosmo
+    css: styles.css
+    toc: true
+    html-math-method: katex
+"""
 
-        sidebar_contents = [{"text": "Home", "href": "index.qmd"}]
+def generate_quarto_yml(notes: List[Note]) -> None:
+    # One sort puts notes in sidebar order (topic, course, then oldest first)
+    ordered = sorted(
+        notes,
+        key=lambda x: (x.topic, x.course, parse_note_date(x.date), x.title.lower()),
+    )
 
-    for topic in sorted(tree.keys()):
+    sidebar_contents = [{"text": "Home", "href": "index.qmd"}]
+    for topic, topic_notes in groupby(ordered, key=lambda x: x.topic):
         topic_section = {"section": topic.replace("_", " "), "contents": []}
-        for course in sorted(tree[topic].keys()):
+        for course, course_notes in groupby(topic_notes, key=lambda x: x.course):
             course_section = {"section": course.replace("_", " "), "contents": []}
-            for n in tree[topic][course]:
-                rel = n.out.relative_to(REPO_ROOT).as_posix()
-                course_section["contents"].append({"text": n.title, "href": rel})
+            for n in course_notes:
+                course_section["contents"].append({"text": n.title, "href": n.rel_href})
             topic_section["contents"].append(course_section)
         sidebar_contents.append(topic_section)
 
-    q = {
-        "project": {"type": "website"},
-        "website": {
-            "title": "Personal Notes",
-            "sidebar": {"style": "docked", "search": True, "contents": sidebar_contents},
-            "page-navigation": True,
-        },
-        "format": {
-            "html": {
-                "theme": "cosmo",
-                "css": "styles.css",
-                "toc": True,
-                "html-math-method": "katex",
-            }
-        }
-    }
+    # Only the sidebar varies between builds; it sits at the "contents:" key's indent
+    if not _HAVE_LIBYAML:
+        print("WARNING: PyYAML built without libyaml; falling back to the slower pure-Python dumper.", file=sys.stderr)
+    sidebar_yml = yaml.dump(sidebar_contents, Dumper=_Dumper, sort_keys=False, width=120 - 4)
+    sidebar_yml = "".join("    " + line for line in sidebar_yml.splitlines(keepends=True))
 
     (REPO_ROOT / "_quarto.yml").write_text(
-        yaml.safe_dump(q, sort_keys=False, width=120),
+        QUARTO_HEADER + sidebar_yml + QUARTO_FOOTER,
         encoding="utf-8"
     )
 
+HOMEPAGE_TEMPLATE = """\
+---
+title: Home
+format:
+  html:
+    toc: false
+---
+
+# Personal Notes
+
+Browse using the sidebar (Topic → Class → Note).
+
+## Recent notes
+
+{recent}
+"""
+
 def write_homepage(notes: List[Note]) -> None:
     notes_sorted = sorted(
         notes,
         key=lambda n: (parse_note_date(n.date), n.title.lower()),
         reverse=True
     )
-    lines = []
-    lines.append("---")
-    lines.append("title: Home")
-    lines.append("format:")
-    lines.append("  html:")
-    lines.append("    toc: false")
-    lines.append("---\n")
-    lines.append("# Personal Notes\n")
-    lines.append("Browse using the sidebar (Topic → Class → Note).")
-    lines.append("\n## Recent notes\n")
-
-    for n in notes_sorted[:30]:
-        rel = n.out.relative_to(REPO_ROOT).as_posix()
-        date = f" — {n.date}" if n.date else ""
-        lines.append(f"- [{n.title}]({rel}){date}")
-
-    (REPO_ROOT / "index.qmd").write_text("\n".join(lines) + "\n", encoding="utf-8")
+    recent = "\n".join(
+        f"- [{n.title}]({n.rel_href})" + (f" — {n.date}" if n.date else "")
+        for n in notes_sorted[:30]
+    )
+    (REPO_ROOT / "index.qmd").write_text(HOMEPAGE_TEMPLATE.format(recent=recent), encoding="utf-8")
 
 def copy_note_assets(note: Note) -> None:
     """
@@ -229,25 +386,90 @@ def copy_note_assets(note: Note) -> None:
     generated notes/ topic/course/ directory so Quarto can find them.
     Convention: assets live in a sibling folder named 'images' or 'assets'.
     """
-    for folder_name in ("images", "assets"):
+    for folder_name in ASSET_DIRS:
         src_dir = note.src.parent / folder_name
         if src_dir.exists() and src_dir.is_dir():
             dst_dir = note.out.parent / folder_name
-            if dst_dir.exists():
-                shutil.rmtree(dst_dir)
-            shutil.copytree(src_dir, dst_dir)
-            
+            if not dst_dir.exists() and _reflink_copy(src_dir, dst_dir):
+                continue
+            sync_tree(src_dir, dst_dir)
+
+def _reflink_copy(src_dir: Path, dst_dir: Path) -> bool:
+    """
+    Fresh copies go through GNU cp so CoW filesystems can clone instead of copying
+    bytes. Returns False if that isn't available (e.g. BSD/macOS cp); sync_tree then
+    copies, or finishes a partial copy.
+    """
+    dst_dir.parent.mkdir(parents=True, exist_ok=True)
+    cmd = ["cp", "-R", "-L", "--reflink=auto", "--preserve=timestamps", str(src_dir), str(dst_dir)]
+    try:
+        return subprocess.run(cmd, capture_output=True).returncode == 0
+    except OSError:
+        return False
+
+def sync_tree(src_dir: Path, dst_dir: Path) -> None:
+    """
+    Mirrors src_dir into dst_dir. Only files whose size or mtime differ are copied
+    (copy2 keeps the mtime, so unchanged files are skipped next run); anything in
+    dst_dir that is no longer in src_dir is removed. copy2 already uses the kernel
+    fast paths (sendfile / fcopyfile) where the platform has them.
+    """
+    for root, dirs, files in os.walk(src_dir, followlinks=True):
+        out_root = dst_dir / Path(root).relative_to(src_dir)
+        if out_root.exists() and not out_root.is_dir():
+            out_root.unlink()
+        out_root.mkdir(parents=True, exist_ok=True)
+
+        for name in files:
+            src = os.path.join(root, name)
+            dst = out_root / name
+            st = os.stat(src)
+            try:
+                dst_st = os.stat(dst)
+            except FileNotFoundError:
+                dst_st = None
+            if dst_st is not None and (
+                dst_st.st_size == st.st_size and dst_st.st_mtime_ns == st.st_mtime_ns
+            ):
+                continue
+            if dst.is_dir():
+                shutil.rmtree(dst)
+            shutil.copy2(src, dst)
+
+        # Drop entries that disappeared from the source side
+        wanted = set(dirs) | set(files)
+        with os.scandir(out_root) as it:
+            stale = [e for e in it if e.name not in wanted]
+        for entry in stale:
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.unlink(entry.path)
+
 def main() -> None:
-    require_pandoc()
+    pandoc_version = require_pandoc()
     tex_files = find_tex_files()
     if not tex_files:
         die(f"No .tex files found under {STAGING_DIR}")
 
     notes = build_notes_index(tex_files)
-    clean_generated_output()
-
-    for n in notes:
-        tex_to_qmd(n)
+    clean_generated_output(notes)
+
+    # pandoc dominates the build and each note is independent, so fan out across cores
+    failures: List[str] = []
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as ex:
+        futures = [ex.submit(tex_to_qmd, n, pandoc_version) for n in notes]
+        for fut in futures:
+            try:
+                fut.result()
+            except Exception as e:
+                failures.append(str(e))
+    if failures:
+        die("\n\n".join(failures))
+
+    # Assets are per source directory; copy each once (and serially, since notes in
+    # the same course share a destination folder)
+    for n in {n.src.parent: n for n in notes}.values():
         copy_note_assets(n)
 
     write_homepage(notes)